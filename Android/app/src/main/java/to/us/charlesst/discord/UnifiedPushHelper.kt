@@ -151,6 +151,15 @@ class UnifiedPushHelper private constructor(context: Context) {
             val guildId = json.optString("guild_id", "")
             val sender = json.optString("sender", "")
             
+            // The backend adds a trace ID when delivery tracing is on. Log the receipt
+            // time so it can be matched to the backend trace (latency assumes synced clocks).
+            val traceId = json.optString("trace_id", "")
+            if (traceId.isNotEmpty()) {
+                val receivedAt = System.currentTimeMillis()
+                val sentAt = json.optLong("sent_at", receivedAt)
+                android.util.Log.i(TAG, "Trace $traceId received at $receivedAt, ${receivedAt - sentAt} ms after send")
+            }
+
             // Check for failed parsing cases and provide fallback message
             if (content.trim().equals("vesktop:", ignoreCase = true) || 
                 content.trim().equals("vesktop", ignoreCase = true)) {
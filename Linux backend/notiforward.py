@@ -12,17 +12,49 @@ import traceback
 import logging
 import sys
 import time
+import threading
+import queue
+import itertools
+import resource
+import tracemalloc
 import jwt
 import base64
+import hashlib
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from urllib.parse import urlparse
 from pywebpush import webpush, WebPushException
 
-# Cache for recent notifications to prevent duplicates
-NOTIFICATION_CACHE = set()
+# Cache for recent notifications to prevent duplicates, maps key -> time bucket.
+# Insertion ordered, so once it is full the oldest entry is evicted first.
+NOTIFICATION_CACHE = {}
 CACHE_TIMEOUT = 5  # seconds
+CACHE_MAX_ENTRIES = 256
+
+# Hard caps on parser buffers. notiforward runs for weeks next to Electron and
+# Xvnc, so a malformed dbus-monitor stream must never grow memory unbounded.
+MAX_RAW_BYTES = 64 * 1024  # raw text kept per message, later lines are not retained
+MAX_STRING_BYTES = 64 * 1024  # a longer string value drops the whole message
+MEMORY_REPORT_INTERVAL = 3600  # seconds between RSS/allocation log lines
+
+# Overflow counters, reported together with the memory stats
+BUFFER_OVERFLOWS = {"cache": 0, "raw": 0, "string": 0}
+
+# Delivery queues, retries and counters, shared by every transport. Worker threads
+# send from the queues so the dbus-monitor reader never blocks on the network;
+# urgent pushes have a worker of their own so a slow normal or low priority send
+# never holds them up.
+DELIVERY_RETRIES = 2
+DELIVERY_RETRY_DELAY = 1  # seconds, doubled after each attempt
+DELIVERY_QUEUE_MAX = 256  # pushes waiting per worker, more are dropped
+DELIVERY_QUEUE = queue.PriorityQueue(maxsize=DELIVERY_QUEUE_MAX)
+URGENT_DELIVERY_QUEUE = queue.PriorityQueue(maxsize=DELIVERY_QUEUE_MAX)
+DELIVERY_SEQUENCE = itertools.count()  # keeps equal priorities in arrival order
+DELIVERY_METRICS = {"sent": 0, "failed": 0, "retries": 0, "dropped": 0}
+DELIVERY_METRICS_LOCK = threading.Lock()
+TRANSPORT = None  # set up by main()
+TRACE_EXPORTER = None  # set up by main() when tracing is configured
 
 # Docker/Environment Variable Configuration
 def load_docker_config():
@@ -32,8 +64,8 @@ def load_docker_config():
         return None
     
     # Validate endpoint format
-    if not endpoint.startswith(('http://', 'https://')):
-        logging.error(f"Invalid NTFY_URL format: {endpoint}. Must start with http:// or https://")
+    if not endpoint.startswith(('http://', 'https://', 'mqtt://', 'mqtts://')):
+        logging.error(f"Invalid NTFY_URL format: {endpoint}. Must start with http://, https://, mqtt:// or mqtts://")
         return None
         
     enable_logging = os.getenv('ENABLE_LOGGING', 'true').lower() == 'true'
@@ -82,7 +114,10 @@ def load_docker_config():
     return {
         'endpoint': endpoint,
         'logging': enable_logging,
-        'vapid': vapid_config
+        'vapid': vapid_config,
+        'transport': os.getenv('TRANSPORT'),
+        'trace_file': os.getenv('TRACE_FILE'),
+        'trace_otlp_url': os.getenv('TRACE_OTLP_URL')
     }
 
 # VAPID Key Generation and Utilities
@@ -356,6 +391,7 @@ parser.add_argument('--re-run-setup', action='store_true', help='Re-run the setu
 parser.add_argument('--service-mode', action='store_true', help='Run in service mode (internal use)')
 parser.add_argument('--uninstall', action='store_true', help='Uninstall notiforward completely')
 parser.add_argument('--fix-service', action='store_true', help='Fix the systemd service for autostart')
+parser.add_argument('--soak-test', type=int, metavar='N', help='Feed N synthetic messages through the parser and check memory stays flat')
 args = parser.parse_args()
 
 # Handle uninstall first, before any other operations
@@ -369,7 +405,7 @@ if args.fix_service:
     sys.exit(0)  # Exit after fixing service
 
 # Handle setup mode
-if not args.service_mode:
+if not args.service_mode and not args.soak_test:
     config_path = Path.home() / '.config' / 'notiforward' / 'config.json'
     if args.re_run_setup:
         load_config(force_setup=True)
@@ -383,13 +419,16 @@ if not args.service_mode:
         sys.exit(0)
 
 # Only continue to main operation if we're in service mode
-if not args.service_mode:
+if not args.service_mode and not args.soak_test:
     sys.exit(0)
 
 # Normal operation - try Docker config first, then fall back to setup wizard
-config = load_docker_config()
+config = None if args.soak_test else load_docker_config()
 
-if config is None:
+if args.soak_test:
+    # The soak test never sends anything, so it needs no endpoint or setup
+    config = {"endpoint": "", "logging": False}
+elif config is None:
     # No Docker config found, use traditional setup wizard
     config = load_config(force_setup=args.re_run_setup)
 else:
@@ -415,18 +454,55 @@ NOTIFY_ARG_BODY = 4
 
 # dbus-monitor never indents the header line of a message
 DBUS_HEADER_RE = re.compile(r'^(method call|method return|signal|error)\b')
+# Wall clock time the bus saw the message, printed in the header
+DBUS_TIME_RE = re.compile(r'\btime=(\d+(?:\.\d+)?)')
 # A string value, optionally wrapped in a variant when it sits inside a hint
 DBUS_STRING_RE = re.compile(r'^(?:variant\s+)?string "')
 
 # Markers that identify a notification as coming from Discord or a Discord client.
-# Vesktop reports itself through the "desktop-entry" hint, so the raw message is
-# still checked for clients that use a generic app name.
+# Vesktop reports itself through the "desktop-entry" hint, so every line of the
+# message is still checked for clients that use a generic app name.
 DISCORD_MARKERS = (
     'dev.vencord.Vesktop',
     'string "vesktop"',
     'string "Discord"',
     'string "discord"',
 )
+# App names that say nothing about the client. Electron based Discord clients can
+# report one of these, so such messages are parsed in full for the markers above;
+# any other app name is decided on its own.
+GENERIC_APP_NAMES = ('', 'electron', 'chromium', 'chrome', 'google chrome')
+
+# Priority classification. The freedesktop "urgency" hint is a byte: 0 low,
+# 1 normal, 2 critical.
+DBUS_URGENCY_KEY = 'string "urgency"'
+DBUS_URGENCY_VALUE_RE = re.compile(r'^variant\s+byte (\d)')
+# Discord titles server messages "Sender (#channel, Server)"; DMs carry only the sender
+SERVER_SUMMARY_RE = re.compile(r'\(#[^()]*\)\s*$')
+MENTION_RE = re.compile(r'(?:^|\s)@\S')
+CALL_RE = re.compile(r'incoming (?:voice |video )?call|is calling you|started a call', re.IGNORECASE)
+
+PRIORITY_URGENT = "urgent"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+
+# Push headers per priority: ntfy reads Priority (1-5), Web Push distributors
+# read Urgency and TTL. A missed call is useless once it stops ringing.
+PRIORITY_HEADERS = {
+    PRIORITY_URGENT: {"Priority": "5", "Urgency": "high", "TTL": "86400"},
+    PRIORITY_NORMAL: {"Priority": "3", "Urgency": "normal", "TTL": "86400"},
+    PRIORITY_LOW: {"Priority": "2", "Urgency": "low", "TTL": "14400"},
+}
+CALL_TTL = "60"
+# Order in which the delivery worker picks up waiting pushes
+PRIORITY_RANKS = {PRIORITY_URGENT: 0, PRIORITY_NORMAL: 1, PRIORITY_LOW: 2}
+
+# Low priority chatter is held back and sent as one push
+LOW_PRIORITY_BATCH_WINDOW = 30  # seconds
+LOW_PRIORITY_BATCH_MAX = 10
+LOW_PRIORITY_BATCH = []
+LOW_PRIORITY_BATCH_LOCK = threading.Lock()
+LOW_PRIORITY_BATCH_TIMER = None  # window timer of the pending batch
 
 
 class NotifyMessageParser:
@@ -437,9 +513,21 @@ class NotifyMessageParser:
     actions array, the hints array and any inline image-data byte array all end
     that way. This parser tracks nesting depth instead and only emits a message
     once all 8 Notify arguments have been collected back at depth 0.
+
+    Discord markers and the urgency hint are picked up as each line arrives, so
+    they survive any cap below. Byte arrays (image-data hints) are never kept
+    in the raw text, other raw text past MAX_RAW_BYTES is no longer retained
+    (the message is still framed and emitted), while a string value longer
+    than MAX_STRING_BYTES, such as an unterminated quote, drops the message
+    and the parser waits for the next header.
+
+    Other apps' notifications are rejected as soon as their app_name argument
+    arrives, after which the rest of the message (image data included) is
+    skipped without parsing until the next header.
     """
 
     def __init__(self):
+        self.rejected = 0
         self._reset()
 
     def _reset(self):
@@ -447,17 +535,60 @@ class NotifyMessageParser:
         self.args = []
         self.lines = []
         self.depth = 0
+        self._raw_bytes = 0
+        self._raw_truncated = False
         self._string_parts = None
+        self._string_bytes = 0
         self._string_capture = False
+        self._in_byte_array = False
+        self._bus_time = None
+        self._discord_marker = False
+        self._urgency_next = False
+        self._urgency = None
+
+    def _keep_line(self, line):
+        """Scan a line for markers and hints, then append it to the raw text
+        unless the per message cap is reached"""
+        if not self._discord_marker:
+            self._discord_marker = any(marker in line for marker in DISCORD_MARKERS)
+        if self._urgency_next:
+            urgency_match = DBUS_URGENCY_VALUE_RE.match(line.strip())
+            if urgency_match:
+                self._urgency = int(urgency_match.group(1))
+            self._urgency_next = False
+        elif line.strip() == DBUS_URGENCY_KEY:
+            self._urgency_next = True
+
+        if self._raw_truncated:
+            return
+        self._raw_bytes += len(line) + 1
+        if self._raw_bytes > MAX_RAW_BYTES:
+            self._raw_truncated = True
+            BUFFER_OVERFLOWS["raw"] += 1
+            logging.warning("Notify message exceeds raw buffer cap, truncating raw text")
+            return
+        self.lines.append(line)
 
     def feed(self, raw_line):
         """Feed one line of output. Returns a parsed message once complete, else None."""
+        # Skip mode: outside a message we keep, only unindented header lines matter
+        if not self.active and raw_line.startswith((' ', '\t')):
+            return None
+
         line = raw_line.rstrip('\n')
 
         # String values may span several lines (Discord messages often do), so
         # keep swallowing raw lines until the closing quote turns up.
         if self._string_parts is not None:
-            self.lines.append(line)
+            self._string_bytes += len(line) + 1
+            if self._string_bytes > MAX_STRING_BYTES:
+                # Most likely an unterminated quote; give up on the whole
+                # message rather than buffering until the stream ends.
+                BUFFER_OVERFLOWS["string"] += 1
+                logging.warning("String value exceeds buffer cap, dropping Notify message")
+                self._reset()
+                return None
+            self._keep_line(line)
             if not line.endswith('"'):
                 self._string_parts.append(line)
                 return None
@@ -477,7 +608,10 @@ class NotifyMessageParser:
             self._reset()
             self.active = 'member=Notify' in line
             if self.active:
-                self.lines.append(line)
+                self._keep_line(line)
+                time_match = DBUS_TIME_RE.search(line)
+                if time_match:
+                    self._bus_time = float(time_match.group(1))
             return None
 
         if not self.active:
@@ -487,7 +621,23 @@ class NotifyMessageParser:
         if not stripped:
             return None
 
-        self.lines.append(line)
+        # Byte array contents are hex dumps: nothing to scan, frame or keep
+        if self._in_byte_array:
+            if stripped != ']':
+                return None
+            self._in_byte_array = False
+
+        # A string value printed on a single line gets the same cap as a multi-line one
+        if len(stripped) > MAX_STRING_BYTES and DBUS_STRING_RE.match(stripped):
+            BUFFER_OVERFLOWS["string"] += 1
+            logging.warning("String value exceeds buffer cap, dropping Notify message")
+            self._reset()
+            return None
+
+        self._keep_line(line)
+
+        if stripped.startswith('array of bytes') and stripped.endswith('['):
+            self._in_byte_array = True
 
         if stripped in (']', ')', '}'):
             self.depth = max(0, self.depth - 1)
@@ -499,10 +649,16 @@ class NotifyMessageParser:
             if not value.endswith('"'):
                 # Opening line of a multi-line string value
                 self._string_parts = [value]
+                self._string_bytes = len(value)
                 self._string_capture = self.depth == 0
                 return None
             if self.depth == 0:
                 self.args.append(value[:-1])
+                if len(self.args) == NOTIFY_ARG_APP_NAME + 1 and not self._wants_app(value[:-1]):
+                    logging.debug(f"Skipping Notify call from '{value[:-1]}'")
+                    self.rejected += 1
+                    self._reset()
+                    return None
             return self._finish_if_complete()
 
         if self.depth == 0:
@@ -514,6 +670,10 @@ class NotifyMessageParser:
 
         return self._finish_if_complete()
 
+    @staticmethod
+    def _wants_app(app_name):
+        return is_discord_app_name(app_name) or app_name.strip().lower() in GENERIC_APP_NAMES
+
     def _finish_if_complete(self):
         if not self.active or self.depth != 0 or len(self.args) < NOTIFY_ARG_COUNT:
             return None
@@ -524,18 +684,51 @@ class NotifyMessageParser:
             "summary": self.args[NOTIFY_ARG_SUMMARY] or "",
             "body": self.args[NOTIFY_ARG_BODY] or "",
             "raw": "\n".join(self.lines),
+            "discord_marker": self._discord_marker,
+            "urgency": self._urgency,
+            "trace": NotificationTrace(self._bus_time),
         }
         self._reset()
-        logging.debug(f"Parsed Notify call: {message}")
+        logging.debug(f"Parsed Notify call {message['trace'].id}: {message}")
         return message
 
 
+def is_discord_app_name(app_name):
+    """Check whether a Notify app_name belongs to Discord or a Discord client"""
+    name = app_name.lower()
+    return 'discord' in name or name == 'vesktop'
+
+
 def is_discord_notification(message):
     """Check whether a parsed Notify call came from Discord or a Discord client"""
-    if 'discord' in message["app_name"].lower() or message["app_name"].lower() == 'vesktop':
-        return True
-    return any(marker in message["raw"] for marker in DISCORD_MARKERS)
+    return is_discord_app_name(message["app_name"]) or message["discord_marker"]
+
+
+def classify_notification(message):
+    """Map a Discord notification to a priority and the push headers that carry it"""
+    summary = message["summary"]
+    text = f"{summary}\n{message['body']}"
 
+    urgency = message["urgency"]
+    if urgency is None:
+        urgency = 1
+
+    is_call = CALL_RE.search(text) is not None
+    if is_call or urgency >= 2 or MENTION_RE.search(message["body"]):
+        priority = PRIORITY_URGENT
+    elif not SERVER_SUMMARY_RE.search(summary.strip()):
+        # Direct and group messages have no channel in the title
+        priority = PRIORITY_URGENT if urgency else PRIORITY_NORMAL
+    else:
+        # Routine server chatter
+        priority = PRIORITY_LOW
+
+    headers = PRIORITY_HEADERS[priority]
+    if is_call:
+        headers = dict(headers, TTL=CALL_TTL)
+
+    logging.info(f"Classified notification as {priority} (urgency hint {urgency})")
+    return priority, headers
 
 def extract_notification_content(message):
     """Turn a parsed Notify call into the payload sent to the push endpoint"""
@@ -574,8 +767,191 @@ def should_ignore_notification(text, content):
 
     return False
 
-def send_webpush_notification(endpoint, message, vapid_config=None):
+def is_duplicate_notification(text):
+    """Check the dedup cache for text and record it, evicting stale or excess entries"""
+    bucket = int(time.time()) // CACHE_TIMEOUT
+    # A fixed size digest keeps every entry small whatever the text length
+    cache_key = f"{hashlib.sha1(text.encode('utf-8')).hexdigest()}_{bucket}"
+    if cache_key in NOTIFICATION_CACHE:
+        return True
+
+    # Drop entries older than the previous bucket, then enforce the size cap
+    for key in [k for k, b in NOTIFICATION_CACHE.items() if b < bucket - 1]:
+        del NOTIFICATION_CACHE[key]
+    while len(NOTIFICATION_CACHE) >= CACHE_MAX_ENTRIES:
+        del NOTIFICATION_CACHE[next(iter(NOTIFICATION_CACHE))]
+        BUFFER_OVERFLOWS["cache"] += 1
+
+    NOTIFICATION_CACHE[cache_key] = bucket
+    return False
+
+def current_rss_kb():
+    """Resident set size of this process in KiB, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+def memory_stats():
+    """Collect RSS, allocation and buffer stats for logging"""
+    stats = {
+        "rss_kb": current_rss_kb(),
+        # ru_maxrss is reported in KiB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "cache_entries": len(NOTIFICATION_CACHE),
+        "overflows": dict(BUFFER_OVERFLOWS),
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats["traced_kb"] = current // 1024
+        stats["traced_peak_kb"] = peak // 1024
+    return stats
+
+def log_runtime_stats():
+    logging.info(f"Memory stats: {memory_stats()}")
+    logging.info(f"Delivery stats: {dict(DELIVERY_METRICS)}")
+    if TRACE_EXPORTER is not None:
+        logging.info(f"Trace exports dropped: {TRACE_EXPORTER.dropped}")
+
+def start_runtime_stats_reporter():
+    """Log runtime stats every MEMORY_REPORT_INTERVAL, even while the bus is idle"""
+    def report():
+        while True:
+            time.sleep(MEMORY_REPORT_INTERVAL)
+            log_runtime_stats()
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+
+def run_soak_test(message_count, tolerance_kb=2048):
+    """Push synthetic dbus-monitor output through the parser and dedup cache and
+    fail if RSS keeps growing once the buffers have warmed up."""
+    parser = NotifyMessageParser()
+    # Every runaway message logs an overflow warning, keep the output readable
+    logging.disable(logging.WARNING)
+
+    def discord_message(i):
+        return [
+            "method call time=1.0 sender=:1.42 -> destination=:1.7 serial=%d path=/org/freedesktop/Notifications; interface=org.freedesktop.Notifications; member=Notify" % i,
+            '   string "vesktop"',
+            '   uint32 0',
+            '   string ""',
+            '   string "user%d"' % (i % 1000),
+            '   string "message %d' % i,
+            'second line"',
+            '   array [',
+            '   ]',
+            '   array [',
+            '      dict entry(',
+            '         string "desktop-entry"',
+            '         variant             string "dev.vencord.Vesktop"',
+            '      )',
+            '   ]',
+            '   int32 -1',
+        ]
+
+    def other_app_message(i):
+        # Another app's notification with an inline image, rejected by the pre-filter
+        lines = discord_message(i)
+        lines[1] = '   string "Thunderbird"'
+        image = ['      struct {', '         int32 48'] + ['            00 11 22 33 44 55 66 77 88 99 aa bb cc dd ee ff'] * 64
+        return lines[:10] + image + ['      }'] + lines[10:]
+
+    def avatar_message(i):
+        # Generic app name with a 48x48 RGBA avatar ahead of the desktop-entry hint
+        lines = discord_message(i)
+        lines[1] = '   string "Electron"'
+        lines[5:7] = ['   string "avatar %d"' % i]
+        image = [
+            '      dict entry(',
+            '         string "image-data"',
+            '         variant             struct {',
+            '               int32 48',
+            '               boolean true',
+            '               array of bytes [',
+        ] + ['                  00 11 22 33 44 55 66 77 88 99 aa bb cc dd ee ff'] * 576 + [
+            '               ]',
+            '            }',
+            '      )',
+        ]
+        return lines[:9] + image + lines[9:]
+
+    def oversized_message(i):
+        # More actions than the raw text cap holds; still framed and emitted
+        lines = discord_message(i)
+        actions = ['      string "action-%d"' % n for n in range(MAX_RAW_BYTES // 16)]
+        return lines[:8] + actions + lines[8:]
+
+    def runaway_message(i):
+        # Unterminated quote followed by far more text than any buffer allows,
+        # or every other time the same amount of text on one line
+        lines = discord_message(i)[:5]
+        if i % 2000 == 999:
+            return lines + ['   string "' + 'x' * (MAX_STRING_BYTES + 1) + '"']
+        return lines + ['   string "never closed'] + ['x' * 1024] * (MAX_STRING_BYTES // 1024 + 1)
+
+    avatars = {"sent": 0, "matched": 0}
+
+    def feed(i):
+        if i % 1000 == 999:
+            generator = runaway_message
+        elif i % 1000 == 499:
+            generator = oversized_message
+        elif i % 100 == 50:
+            generator = avatar_message
+            avatars["sent"] += 1
+        elif i % 2:
+            generator = other_app_message
+        else:
+            generator = discord_message
+        for line in generator(i):
+            message = parser.feed(line + "\n")
+            if message is not None and is_discord_notification(message):
+                if message["body"].startswith("avatar"):
+                    avatars["matched"] += 1
+                is_duplicate_notification(extract_notification_content(message)["text"])
+
+    warmup = min(message_count // 10, 100000)
+    for i in range(warmup):
+        feed(i)
+    baseline = current_rss_kb()
+    for i in range(warmup, message_count):
+        feed(i)
+    final = current_rss_kb()
+
+    stats = memory_stats()
+    rprint(f"[blue]Soak test: {message_count} messages, RSS {baseline} KiB -> {final} KiB[/blue]")
+    rprint(f"[blue]{stats}, pre-filter skipped {parser.rejected}, avatars {avatars}[/blue]")
+    if avatars["matched"] != avatars["sent"]:
+        rprint("[red]✗ Notifications with an avatar were not matched as Discord[/red]")
+        return 1
+    unexercised = [name for name, count in BUFFER_OVERFLOWS.items() if not count]
+    if unexercised:
+        rprint(f"[red]✗ Overflow paths not exercised: {', '.join(unexercised)} (use at least 1000 messages)[/red]")
+        return 1
+    if baseline is None or final is None:
+        rprint("[yellow]RSS unavailable on this platform, growth not checked[/yellow]")
+        return 0
+    if final - baseline > tolerance_kb:
+        rprint(f"[red]✗ RSS grew by {final - baseline} KiB[/red]")
+        return 1
+    rprint("[green]✓ Memory stayed flat[/green]")
+    return 0
+
+class PermanentDeliveryError(Exception):
+    """The push server rejected a message; sending it again will not help"""
+
+
+def is_permanent_failure(status_code):
+    """4xx responses are permanent, except timeouts and rate limiting"""
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+def send_webpush_notification(endpoint, message, vapid_config=None, headers=None):
     """Send web push notification with optional VAPID authentication."""
+    headers = headers or {}
     try:
         if vapid_config:
             # Use VAPID authenticated web push
@@ -590,14 +966,16 @@ def send_webpush_notification(endpoint, message, vapid_config=None):
             
             if not vapid_jwt:
                 logging.error("Failed to create VAPID JWT, falling back to regular HTTP")
-                return send_regular_notification(endpoint, message)
+                return send_regular_notification(endpoint, message, headers)
             
             # Use pywebpush for proper web push with VAPID
             response = webpush(
                 subscription_info={'endpoint': endpoint},
                 data=message,
                 vapid_private_key=vapid_config['private_key'],
-                vapid_claims={'sub': 'mailto:admin@example.com'}
+                vapid_claims={'sub': 'mailto:admin@example.com'},
+                headers={k: v for k, v in headers.items() if k != 'TTL'},
+                ttl=int(headers.get('TTL', 0))
             )
             
             logging.info(f"Web push with VAPID sent successfully")
@@ -606,19 +984,22 @@ def send_webpush_notification(endpoint, message, vapid_config=None):
         else:
             # Fall back to regular HTTP POST
             logging.info("No VAPID config, falling back to regular HTTP POST")
-            return send_regular_notification(endpoint, message)
+            return send_regular_notification(endpoint, message, headers)
             
+    except PermanentDeliveryError:
+        raise
     except WebPushException as e:
         logging.error(f"Web push failed: {e}")
         logging.info("Falling back to regular HTTP POST")
-        return send_regular_notification(endpoint, message)
+        return send_regular_notification(endpoint, message, headers)
     except Exception as e:
         logging.error(f"Unexpected error in web push: {e}")
         logging.info("Falling back to regular HTTP POST")
-        return send_regular_notification(endpoint, message)
+        return send_regular_notification(endpoint, message, headers)
 
-def send_regular_notification(endpoint, message):
+def send_regular_notification(endpoint, message, headers=None):
     """Send notification using regular HTTP POST (legacy method)."""
+    headers = headers or {}
     try:
         # Try both text and JSON formats
         text_content = message if isinstance(message, str) else str(message)
@@ -628,7 +1009,7 @@ def send_regular_notification(endpoint, message):
         res = requests.post(
             endpoint,
             data=text_content,
-            headers={"Content-Type": "text/plain"},
+            headers={**headers, "Content-Type": "text/plain"},
             timeout=10
         )
         
@@ -641,31 +1022,573 @@ def send_regular_notification(endpoint, message):
         try:
             json_data = json.loads(text_content) if isinstance(text_content, str) else text_content
             json_content = json.dumps(json_data)
-            
+        except (json.JSONDecodeError, TypeError):
+            logging.error("Failed to parse message as JSON")
+        else:
             logging.warning("Plain text failed, trying JSON format...")
             res = requests.post(
                 endpoint,
                 data=json_content,
-                headers={"Content-Type": "application/json"},
+                headers={**headers, "Content-Type": "application/json"},
                 timeout=10
             )
             
             logging.info(f"JSON response status: {res.status_code}")
-            return res.status_code <= 299
-            
-        except (json.JSONDecodeError, TypeError):
-            logging.error("Failed to parse message as JSON")
-            return False
+            if res.status_code <= 299:
+                return True
+
+        if is_permanent_failure(res.status_code):
+            raise PermanentDeliveryError(f"Push server rejected the message with HTTP {res.status_code}")
+        return False
             
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
         logging.error(f"Regular notification failed: {e}")
         return False
 
+class Transport:
+    """Delivery backend. Subclasses own their connection lifecycle; queueing,
+    retries and metrics are handled once in deliver_notification()."""
+
+    name = "base"
+
+    def connect(self):
+        """Open the connection, returning False on failure. Errors are logged,
+        never raised, so a failed connect is retried like a failed send."""
+        return True
+
+    def send(self, message, headers):
+        """Deliver one message, returning True on success and False on a failure
+        worth retrying. Raises PermanentDeliveryError when the server rejects it."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HttpTransport(Transport):
+    """One request per message: VAPID web push with a plain HTTP POST fallback"""
+
+    name = "http"
+
+    def __init__(self, endpoint, vapid_config=None):
+        self.endpoint = endpoint
+        self.vapid_config = vapid_config
+
+    def send(self, message, headers):
+        return send_webpush_notification(self.endpoint, message, self.vapid_config, headers)
+
+
+class StreamTransport(Transport):
+    """Publish over persistent keep-alive connections to ntfy or another
+    UnifiedPush server, saving the TCP/TLS handshake on every message.
+
+    requests sessions are not thread safe, so each delivery worker keeps its
+    own connection.
+    """
+
+    name = "stream"
+    VAPID_TOKEN_LIFETIME = 6 * 3600  # seconds, well inside the 12 hour JWT expiry
+
+    def __init__(self, endpoint, vapid_config=None):
+        self.endpoint = endpoint
+        self.vapid_config = vapid_config
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+        self._vapid_token = None
+        self._vapid_token_time = 0
+
+    @property
+    def session(self):
+        return getattr(self._local, 'session', None)
+
+    def connect(self):
+        session = requests.Session()
+        self._local.session = session
+        with self._sessions_lock:
+            self._sessions.append(session)
+        logging.info(f"Opened persistent connection to {self.endpoint}")
+        return True
+
+    def _authorization(self):
+        if not self.vapid_config:
+            return None
+        if time.time() - self._vapid_token_time > self.VAPID_TOKEN_LIFETIME:
+            token = create_vapid_jwt(
+                self.endpoint,
+                self.vapid_config['private_key'],
+                self.vapid_config['vapid_public_key']
+            )
+            # On failure keep the old token, if any, and try again next send
+            if token:
+                self._vapid_token = token
+                self._vapid_token_time = time.time()
+        return self._vapid_token
+
+    def send(self, message, headers):
+        if self.session is None:
+            self.connect()
+        request_headers = {**headers, "Content-Type": "text/plain"}
+        authorization = self._authorization()
+        if authorization:
+            request_headers["Authorization"] = authorization
+        try:
+            res = self.session.post(self.endpoint, data=message.encode('utf-8'), headers=request_headers, timeout=10)
+            logging.info(f"Stream publish response status: {res.status_code}")
+            if is_permanent_failure(res.status_code):
+                raise PermanentDeliveryError(f"Push server rejected the message with HTTP {res.status_code}")
+            return res.status_code <= 299
+        except requests.RequestException as e:
+            # Drop the broken connection, the next send reconnects
+            logging.error(f"Stream publish failed: {e}")
+            self._drop_session(self.session)
+            return False
+
+    def _drop_session(self, session):
+        session.close()
+        self._local.session = None
+        with self._sessions_lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def close(self):
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        self._local.session = None
+
+
+class MqttTransport(Transport):
+    """Publish to an MQTT broker, endpoint format mqtt[s]://[user:pass@]host[:port]/topic"""
+
+    name = "mqtt"
+
+    def __init__(self, endpoint):
+        parsed = urlparse(endpoint)
+        self.host = parsed.hostname
+        self.tls = parsed.scheme == 'mqtts'
+        self.port = parsed.port or (8883 if self.tls else 1883)
+        self.username = parsed.username
+        self.password = parsed.password
+        self.topic = parsed.path.lstrip('/')
+        self.client = None
+
+    def connect(self):
+        try:
+            import paho.mqtt.client as mqtt
+        except ImportError:
+            logging.error("MQTT transport needs paho-mqtt (pip install paho-mqtt)")
+            return False
+
+        # paho-mqtt 2.x requires the callback API version, 1.x does not accept it
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            client = mqtt.Client()
+        try:
+            if self.username:
+                client.username_pw_set(self.username, self.password)
+            if self.tls:
+                client.tls_set()
+            client.connect(self.host, self.port)
+        except Exception as e:
+            logging.error(f"Failed to connect to MQTT broker {self.host}:{self.port}: {e}")
+            return False
+        # The network loop thread handles keepalives and reconnects
+        client.loop_start()
+        self.client = client
+        logging.info(f"Connected to MQTT broker {self.host}:{self.port}, topic '{self.topic}'")
+        return True
+
+    def send(self, message, headers):
+        if self.client is None and not self.connect():
+            return False
+        payload = json.dumps({
+            "message": message,
+            "priority": int(headers.get("Priority", 3)),
+            "urgency": headers.get("Urgency", "normal"),
+            "ttl": int(headers.get("TTL", 0)),
+        })
+        try:
+            info = self.client.publish(self.topic, payload, qos=1)
+            info.wait_for_publish(timeout=10)
+        except (RuntimeError, ValueError) as e:
+            # Raised while the loop thread is still reconnecting to the broker
+            logging.error(f"MQTT publish failed: {e}")
+            return False
+        return info.is_published()
+
+    def close(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.client = None
+
+
+TRANSPORTS = {
+    HttpTransport.name: HttpTransport,
+    StreamTransport.name: StreamTransport,
+    MqttTransport.name: MqttTransport,
+}
+
+def create_transport(config):
+    """Pick the delivery backend from the config, defaulting by endpoint scheme"""
+    endpoint = config["endpoint"]
+    name = config.get("transport") or ("mqtt" if endpoint.startswith(('mqtt://', 'mqtts://')) else "http")
+    if name not in TRANSPORTS:
+        logging.error(f"Unknown transport '{name}', falling back to http")
+        name = "http"
+    logging.info(f"Using {name} transport")
+    if name == MqttTransport.name:
+        return MqttTransport(endpoint)
+    return TRANSPORTS[name](endpoint, config.get("vapid"))
+
+class NotificationTrace:
+    """Timestamps of one notification on its way from the bus to the push server.
+
+    Stages are marked in order: bus (from the dbus-monitor header), parsed,
+    filtered, deduped, batched (low priority only), queued, sending, retry_1
+    and so on for each retry, fallback when the bare last-resort message is
+    sent, and finally delivered or failed. Every send
+    attempt is also kept with its start, end and outcome, so network time
+    can be told apart from the backoff between attempts.
+    """
+
+    def __init__(self, bus_time=None):
+        self.id = os.urandom(16).hex()
+        self.priority = None
+        self.stages = {}
+        self.attempts = []
+        if bus_time is not None:
+            self.stages["bus"] = bus_time
+        self.mark("parsed")
+
+    def mark(self, stage):
+        self.stages[stage] = time.time()
+
+    def start_attempt(self, attempt, stage=None):
+        stage = stage or (f"retry_{attempt}" if attempt else "sending")
+        self.mark(stage)
+        self.attempts.append({"stage": stage, "start": self.stages[stage], "end": None, "outcome": None})
+
+    def end_attempt(self, outcome):
+        self.attempts[-1]["end"] = time.time()
+        self.attempts[-1]["outcome"] = outcome
+
+    def to_record(self, success):
+        names = list(self.stages)
+        times = list(self.stages.values())
+        return {
+            "trace_id": self.id,
+            "priority": self.priority,
+            "success": success,
+            "stages": self.stages,
+            # Time spent getting to each stage from the previous one
+            "durations_ms": {
+                name: round((end - start) * 1000, 3)
+                for name, start, end in zip(names[1:], times, times[1:])
+            },
+            "total_ms": round((times[-1] - times[0]) * 1000, 3),
+            "attempts": [
+                dict(attempt, duration_ms=round((attempt["end"] - attempt["start"]) * 1000, 3))
+                for attempt in self.attempts if attempt["end"] is not None
+            ],
+        }
+
+
+class TraceExporter:
+    """Export finished traces from one background thread, so a slow disk or
+    collector never delays delivery. Traces beyond QUEUE_SIZE are dropped."""
+
+    QUEUE_SIZE = 256
+
+    def __init__(self):
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def export(self, trace, success):
+        try:
+            self._queue.put_nowait((trace, success))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Trace export queue is full, dropping trace {trace.id}")
+
+    def _run(self):
+        while True:
+            trace, success = self._queue.get()
+            try:
+                self._write(trace, success)
+            except Exception as e:
+                logging.error(f"Failed to export trace {trace.id}: {e}")
+
+    def _write(self, trace, success):
+        raise NotImplementedError
+
+
+class FileTraceExporter(TraceExporter):
+    """Append one JSON line per notification to a local trace file. Past
+    TRACE_FILE_MAX_BYTES the file is rotated to <path>.1, replacing the old one."""
+
+    TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = Path(path)
+        super().__init__()
+
+    def _write(self, trace, success):
+        if self.path.exists() and self.path.stat().st_size >= self.TRACE_FILE_MAX_BYTES:
+            self.path.replace(self.path.with_name(self.path.name + '.1'))
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(json.dumps(trace.to_record(success)) + "\n")
+
+
+class OtlpTraceExporter(TraceExporter):
+    """Post spans as OTLP/HTTP JSON to a collector, e.g. http://localhost:4318/v1/traces.
+
+    Each notification becomes a root span with one child span per stage, plus
+    one per send attempt and per backoff between attempts.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        super().__init__()
+
+    @staticmethod
+    def _attribute(key, value):
+        kind = "boolValue" if isinstance(value, bool) else "stringValue"
+        return {"key": key, "value": {kind: value if isinstance(value, bool) else str(value)}}
+
+    def _to_otlp(self, trace, success):
+        root_id = os.urandom(8).hex()
+        names = list(trace.stages)
+        nanos = [str(int(t * 1e9)) for t in trace.stages.values()]
+        spans = [{
+            "traceId": trace.id,
+            "spanId": root_id,
+            "name": "notification",
+            "kind": 1,
+            "startTimeUnixNano": nanos[0],
+            "endTimeUnixNano": nanos[-1],
+            "attributes": [
+                self._attribute("notification.priority", trace.priority),
+                self._attribute("notification.success", success),
+            ],
+        }]
+        for name, start, end in zip(names[1:], nanos, nanos[1:]):
+            spans.append(self._child_span(trace, root_id, name, start, end))
+
+        # Network time of every send attempt, and the backoff between them
+        previous_end = None
+        for attempt in trace.attempts:
+            if attempt["end"] is None:
+                continue
+            start = str(int(attempt["start"] * 1e9))
+            if previous_end is not None:
+                spans.append(self._child_span(trace, root_id, "backoff", previous_end, start))
+            previous_end = str(int(attempt["end"] * 1e9))
+            span = self._child_span(trace, root_id, f"attempt {attempt['stage']}", start, previous_end)
+            span["attributes"] = [self._attribute("attempt.outcome", attempt["outcome"])]
+            spans.append(span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [self._attribute("service.name", "notiforward")]},
+            "scopeSpans": [{"scope": {"name": "notiforward"}, "spans": spans}],
+        }]}
+
+    @staticmethod
+    def _child_span(trace, parent_id, name, start, end):
+        return {
+            "traceId": trace.id,
+            "spanId": os.urandom(8).hex(),
+            "parentSpanId": parent_id,
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": start,
+            "endTimeUnixNano": end,
+        }
+
+    def _write(self, trace, success):
+        requests.post(self.url, json=self._to_otlp(trace, success), timeout=5)
+
+def create_trace_exporter(config):
+    """Pick the trace exporter from the config, or None when tracing is off"""
+    if config.get("trace_otlp_url"):
+        logging.info(f"Exporting delivery traces to {config['trace_otlp_url']}")
+        return OtlpTraceExporter(config["trace_otlp_url"])
+    if config.get("trace_file"):
+        logging.info(f"Writing delivery traces to {config['trace_file']}")
+        return FileTraceExporter(config["trace_file"])
+    return None
+
+def build_payload(items):
+    """Build the push body for a list of (notification_data, trace) pairs"""
+    text = "\n".join(data["text"] for data, _ in items)
+    if TRACE_EXPORTER is None:
+        return text
+
+    # With tracing on, send JSON so the Android app can log receipt latency
+    if len(items) == 1:
+        payload = json.loads(items[0][0]["json"])
+    else:
+        payload = {"title": "Discord", "content": text, "sender": "", "channel_id": "", "guild_id": ""}
+    payload["trace_id"] = ",".join(trace.id for _, trace in items)
+    payload["sent_at"] = int(time.time() * 1000)
+    return json.dumps(payload)
+
+def count_delivery(outcome):
+    with DELIVERY_METRICS_LOCK:
+        DELIVERY_METRICS[outcome] += 1
+
+def enqueue_delivery(items, headers, priority, attempt=0):
+    """Hand (notification_data, trace) pairs to a delivery worker as one push.
+    Urgent pushes go to their own worker, normal ones are picked up before low."""
+    if not attempt:
+        for _, trace in items:
+            trace.mark("queued")
+    entry = (PRIORITY_RANKS[priority], next(DELIVERY_SEQUENCE), items, headers, priority, attempt)
+    delivery_queue = URGENT_DELIVERY_QUEUE if priority == PRIORITY_URGENT else DELIVERY_QUEUE
+    try:
+        delivery_queue.put_nowait(entry)
+    except queue.Full:
+        count_delivery("dropped")
+        logging.error(f"Delivery queue is full, dropping {priority} notification")
+        finish_traces(items, False)
+
+def delivery_worker(delivery_queue):
+    """Send pushes from one queue one at a time, off the dbus-monitor reader thread"""
+    while True:
+        _, _, items, headers, priority, attempt = delivery_queue.get()
+        try:
+            deliver_notification(items, headers, priority, attempt)
+        except Exception as e:
+            logging.error(f"Delivery worker error: {e}")
+            logging.error(traceback.format_exc())
+        finally:
+            delivery_queue.task_done()
+
+def finish_traces(items, success):
+    for _, trace in items:
+        trace.mark("delivered" if success else "failed")
+        logging.info(f"Trace {trace.id}: {trace.to_record(success)['durations_ms']}")
+        if TRACE_EXPORTER is not None:
+            TRACE_EXPORTER.export(trace, success)
+
+def deliver_notification(items, headers, priority, attempt=0):
+    """Make one attempt at sending (notification_data, trace) pairs as one push.
+    Failures worth retrying go back on the queue after a backoff delay,
+    rejected messages are dropped and an unexpected error falls back to a
+    bare message, which counts as delivered if it gets through."""
+    payload = build_payload(items)
+    traces = [trace for _, trace in items]
+    success = False
+    retry = False
+    for trace in traces:
+        trace.start_attempt(attempt)
+    try:
+        # Log more details about the message
+        logging.info("===== PREPARING TO SEND NOTIFICATION =====")
+        logging.info(f"Raw notification content: {payload}")
+
+        success = TRANSPORT.send(payload, headers)
+        for trace in traces:
+            trace.end_attempt("sent" if success else "failed")
+
+        if success:
+            logging.info("===== NOTIFICATION SENT SUCCESSFULLY =====")
+        else:
+            logging.error("===== NOTIFICATION SENDING FAILED =====")
+            retry = attempt < DELIVERY_RETRIES
+
+    except PermanentDeliveryError as e:
+        for trace in traces:
+            trace.end_attempt("rejected")
+        logging.error(f"===== NOTIFICATION REJECTED, NOT RETRYING: {e} =====")
+
+    except Exception as e:
+        for trace in traces:
+            trace.end_attempt("error")
+        logging.error(f"Failed to send notification: {e}")
+        logging.error(traceback.format_exc())
+        logging.error("===== NOTIFICATION SENDING FAILED WITH EXCEPTION =====")
+
+        # As a last resort, try a very simple message
+        for trace in traces:
+            trace.start_attempt(attempt, stage="fallback")
+        try:
+            logging.info("Attempting last resort simple message")
+            success = TRANSPORT.send("New Discord message", headers)
+        except Exception as fallback_error:
+            logging.error(f"Even simple fallback failed: {fallback_error}")
+        for trace in traces:
+            trace.end_attempt("sent" if success else "failed")
+
+    if retry:
+        # Re-queue from a timer so the worker keeps sending meanwhile
+        delay = DELIVERY_RETRY_DELAY * 2 ** attempt
+        count_delivery("retries")
+        logging.warning(f"Retrying delivery in {delay}s (attempt {attempt + 2})")
+        timer = threading.Timer(delay, enqueue_delivery, args=(items, headers, priority, attempt + 1))
+        timer.daemon = True
+        timer.start()
+        return
+
+    count_delivery("sent" if success else "failed")
+    finish_traces(items, success)
+
+def queue_low_priority_notification(notification_data, trace):
+    """Hold a low priority notification back so chatter goes out as one push"""
+    global LOW_PRIORITY_BATCH_TIMER
+    trace.mark("batched")
+    with LOW_PRIORITY_BATCH_LOCK:
+        LOW_PRIORITY_BATCH.append((notification_data, trace))
+        batch_size = len(LOW_PRIORITY_BATCH)
+        if batch_size == 1:
+            # The first notification of a batch opens its window
+            LOW_PRIORITY_BATCH_TIMER = threading.Timer(LOW_PRIORITY_BATCH_WINDOW, flush_low_priority_batch)
+            LOW_PRIORITY_BATCH_TIMER.daemon = True
+            LOW_PRIORITY_BATCH_TIMER.start()
+
+    logging.info(f"Queued low priority notification ({batch_size} pending)")
+    if batch_size >= LOW_PRIORITY_BATCH_MAX:
+        flush_low_priority_batch()
+
+def flush_low_priority_batch():
+    """Send every queued low priority notification as a single push"""
+    global LOW_PRIORITY_BATCH_TIMER
+    with LOW_PRIORITY_BATCH_LOCK:
+        batch = LOW_PRIORITY_BATCH[:]
+        LOW_PRIORITY_BATCH.clear()
+        # A size triggered flush must not leave this window's timer to cut the next batch short
+        if LOW_PRIORITY_BATCH_TIMER is not None:
+            LOW_PRIORITY_BATCH_TIMER.cancel()
+            LOW_PRIORITY_BATCH_TIMER = None
+
+    if not batch:
+        return
+
+    logging.info(f"Sending batch of {len(batch)} low priority notifications")
+    enqueue_delivery(batch, PRIORITY_HEADERS[PRIORITY_LOW], PRIORITY_LOW)
+
 def main():
+    global TRANSPORT, TRACE_EXPORTER
     try:
+        TRANSPORT = create_transport(config)
+        if not TRANSPORT.connect():
+            logging.warning(f"{TRANSPORT.name} transport is not connected yet, retrying on the first delivery")
+        for delivery_queue in (URGENT_DELIVERY_QUEUE, DELIVERY_QUEUE):
+            worker = threading.Thread(target=delivery_worker, args=(delivery_queue,))
+            worker.daemon = True
+            worker.start()
+        TRACE_EXPORTER = create_trace_exporter(config)
+
         logging.info("Starting dbus-monitor process...")
         process = subprocess.Popen(
-            ['dbus-monitor', "eavesdrop=true,interface='org.freedesktop.Notifications',member='Notify'"],
+            ['dbus-monitor', "eavesdrop=true,type='method_call',interface='org.freedesktop.Notifications',member='Notify'"],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True
@@ -675,14 +1598,26 @@ def main():
 
         # Feed lines to the parser until it reports a complete Notify call
         parser = NotifyMessageParser()
+        # Formatting every raw line is costly with chatty apps, only do it when it is logged
+        debug_raw_lines = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        if os.getenv('NOTIFORWARD_TRACEMALLOC', 'false').lower() == 'true':
+            tracemalloc.start()
+        log_runtime_stats()
+        start_runtime_stats_reporter()
 
         while True:
             line = process.stdout.readline()
             if not line:
                 logging.error("dbus-monitor process ended unexpectedly")
+                flush_low_priority_batch()
+                # Let the workers send what is already queued before shutting down
+                URGENT_DELIVERY_QUEUE.join()
+                DELIVERY_QUEUE.join()
                 break
 
-            logging.debug(f"Raw line: {line.rstrip()}")
+            if debug_raw_lines:
+                logging.debug(f"Raw line: {line.rstrip()}")
             notification = parser.feed(line)
             if notification is None:
                 continue
@@ -693,6 +1628,10 @@ def main():
                 continue
 
             logging.info("Matched Discord notification!")
+            trace = notification["trace"]
+            priority, headers = classify_notification(notification)
+            trace.priority = priority
+            trace.mark("filtered")
             notification_data = extract_notification_content(notification)
             json_content = notification_data["json"]
             text_content = notification_data["text"]
@@ -707,53 +1646,29 @@ def main():
                 continue
 
             # Check if this is a duplicate notification
-            cache_key = f"{text_content}_{int(time.time()) // CACHE_TIMEOUT}"
-            if cache_key in NOTIFICATION_CACHE:
+            if is_duplicate_notification(text_content):
                 logging.info("Skipping duplicate notification")
                 continue
+            trace.mark("deduped")
 
-            # Add to cache and clean old entries
-            current_time = int(time.time())
-            NOTIFICATION_CACHE.add(cache_key)
-            NOTIFICATION_CACHE.difference_update(
-                [k for k in NOTIFICATION_CACHE
-                 if int(k.split('_')[1]) < current_time // CACHE_TIMEOUT - 1]
-            )
-
-            try:
-                # Log more details about the message
-                logging.info("===== PREPARING TO SEND NOTIFICATION =====")
-                logging.info(f"Raw notification content: {text_content}")
-                logging.info(f"JSON content: {json_content}")
-
-                # Use the new VAPID-enabled web push function
-                vapid_config = config.get("vapid")
-                success = send_webpush_notification(endpoint, text_content, vapid_config)
-
-                if success:
-                    logging.info("===== NOTIFICATION SENT SUCCESSFULLY =====")
-                else:
-                    logging.error("===== NOTIFICATION SENDING FAILED =====")
-
-            except Exception as e:
-                logging.error(f"Failed to send notification: {e}")
-                logging.error(traceback.format_exc())
-                logging.error("===== NOTIFICATION SENDING FAILED WITH EXCEPTION =====")
-
-                # As a last resort, try a very simple message
-                try:
-                    logging.info("Attempting last resort simple message")
-                    send_regular_notification(endpoint, "New Discord message")
-                except Exception as fallback_error:
-                    logging.error(f"Even simple fallback failed: {fallback_error}")
-
+            logging.info(f"JSON content: {json_content}")
+            if priority == PRIORITY_LOW:
+                queue_low_priority_notification(notification_data, trace)
+            else:
+                # Urgent and normal notifications go straight out
+                enqueue_delivery([(notification_data, trace)], headers, priority)
 
     except Exception as e:
         logging.error(f"Failed to start or monitor notifications: {e}")
         logging.error(traceback.format_exc())
         return 1
+    finally:
+        if TRANSPORT is not None:
+            TRANSPORT.close()
     
     return 0
 
 if __name__ == "__main__":
+    if args.soak_test:
+        exit(run_soak_test(args.soak_test))
     exit(main())